@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 import numpy as np
 import torch
 
@@ -59,3 +61,72 @@ def np_to_pytorch_batch(np_batch):
         if x.dtype != np.dtype('O')  # ignore object (e.g. dictionaries)
     }
 
+
+def _split_views(flat, shapes):
+    sizes = [int(np.prod(shape)) for shape in shapes.values()]
+    return OrderedDict(
+        (key, segment.view(shape))
+        for (key, shape), segment in zip(shapes.items(), flat.split(sizes))
+    )
+
+
+class BatchBuffers(object):
+    """
+    Moves numpy batches to a CUDA device with a single non-blocking copy.
+
+    Every field of the batch is converted to float32 and written into its
+    own contiguous segment of one pinned host buffer. The whole buffer is
+    copied at once into a matching device buffer, and the returned tensors
+    are views into it, so they are only valid until the next call. Two
+    host buffers are alternated so that filling the next batch never
+    overwrites one whose copy may still be in flight.
+
+    Batches for other devices, or with tuple fields, fall back to
+    np_to_pytorch_batch.
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self._shapes = None
+
+    def _allocate(self, shapes):
+        self._shapes = shapes
+        total = sum(int(np.prod(shape)) for shape in shapes.values())
+        self._host_bufs = [
+            torch.empty(total, pin_memory=True) for _ in range(2)
+        ]
+        self._host_views = [
+            _split_views(buf, shapes) for buf in self._host_bufs
+        ]
+        self._copy_events = [None, None]
+        self._next_host_buf = 0
+        self._device_buf = torch.empty(total, device=self.device)
+        self._device_views = _split_views(self._device_buf, shapes)
+
+    def to_device(self, np_batch):
+        if self.device.type != 'cuda' or not all(
+                isinstance(x, np.ndarray) for x in np_batch.values()
+        ):
+            return np_to_pytorch_batch(np_batch)
+        np_batch = OrderedDict(
+            (k, x) for k, x in np_batch.items()
+            if x.dtype != np.dtype('O')  # ignore object (e.g. dictionaries)
+        )
+        shapes = OrderedDict((k, x.shape) for k, x in np_batch.items())
+        if shapes != self._shapes:
+            self._allocate(shapes)
+
+        i = self._next_host_buf
+        self._next_host_buf = 1 - i
+        if self._copy_events[i] is not None:
+            self._copy_events[i].synchronize()
+        for k, x in np_batch.items():
+            self._host_views[i][k].copy_(
+                torch.from_numpy(np.ascontiguousarray(x))
+            )
+        # record on the stream of self.device, which need not be current
+        with torch.cuda.device(self.device):
+            self._device_buf.copy_(self._host_bufs[i], non_blocking=True)
+            self._copy_events[i] = torch.cuda.Event()
+            self._copy_events[i].record()
+        return OrderedDict(self._device_views)
@@ -152,10 +152,15 @@ class Mlp_embedding(nn.Module):
 class FlattenMlp(Mlp):
     """
     Flatten inputs along dimension 1 and then pass through MLP.
+
+    A single input is assumed to be flattened already and is not copied.
     """
 
     def forward(self, *inputs, **kwargs):
-        flat_inputs = torch.cat(inputs, dim=1)
+        if len(inputs) == 1:
+            flat_inputs = inputs[0]
+        else:
+            flat_inputs = torch.cat(inputs, dim=1)
         return super().forward(flat_inputs, **kwargs)
 
 
@@ -9,6 +9,19 @@ def soft_update_from_to(source, target, tau):
         )
 
 
+def soft_update_params_from_to(source_params, target_params, tau):
+    """
+    Same as soft_update_from_to, but over lists of parameters that may span
+    several networks, updated together with one multi-tensor lerp.
+    """
+    with torch.no_grad():
+        if hasattr(torch, '_foreach_lerp_'):
+            torch._foreach_lerp_(target_params, source_params, tau)
+        else:
+            for target_param, param in zip(target_params, source_params):
+                target_param.lerp_(param, tau)
+
+
 def copy_model_params_from_to(source, target):
     for target_param, param in zip(target.parameters(), source.parameters()):
         target_param.data.copy_(param.data)
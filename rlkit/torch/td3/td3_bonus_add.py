@@ -1,15 +1,218 @@
+import inspect
 from collections import OrderedDict
 
-import numpy as np
 import torch
 import torch.optim as optim
 from torch import nn as nn
+from torch.nn import functional as F
 
 import rlkit.torch.pytorch_util as ptu
-from rlkit.core.eval_util import create_stats_ordered_dict
+from rlkit.torch.core import BatchBuffers
+from rlkit.torch.networks import FlattenMlp, Mlp
 from rlkit.torch.torch_rl_algorithm import TorchTrainer
 
 
+def _can_fuse_twin_q(qf1, qf2):
+    """
+    Two critics can share batched matmuls only if they are plain
+    FlattenMlps with identical layer shapes and activations.
+    """
+    if not (isinstance(qf1, FlattenMlp) and isinstance(qf2, FlattenMlp)):
+        return False
+    if qf1.layer_norm or qf2.layer_norm:
+        return False
+    if (qf1.hidden_activation is not qf2.hidden_activation
+            or qf1.output_activation is not qf2.output_activation):
+        return False
+    fcs1 = qf1.fcs + [qf1.last_fc]
+    fcs2 = qf2.fcs + [qf2.last_fc]
+    return len(fcs1) == len(fcs2) and all(
+        fc1.weight.shape == fc2.weight.shape for fc1, fc2 in zip(fcs1, fcs2)
+    )
+
+
+def _twin_linear(h, fc1, fc2):
+    weight = torch.stack((fc1.weight, fc2.weight)).transpose(1, 2)
+    bias = torch.stack((fc1.bias, fc2.bias)).unsqueeze(1)
+    return torch.baddbmm(bias, h, weight)
+
+
+def _twin_q(qf1, qf2, obs, actions, fuse, flat_input):
+    """
+    Evaluate both critics on (obs, actions) and return their Q-values
+    stacked along a new leading dimension, i.e. with shape (2, batch, 1).
+
+    If `fuse` is set, each layer of the pair runs as a single matmul: the
+    first layer on the shared input with the two weight matrices
+    concatenated, the remaining layers as one batched matmul. Otherwise,
+    critics with `flat_input` are both given the same concatenated input.
+    """
+    if not (fuse or flat_input):
+        return torch.stack((qf1(obs, actions), qf2(obs, actions)))
+    h = torch.cat((obs, actions), dim=1)
+    if not fuse:
+        return torch.stack((qf1(h), qf2(h)))
+    if qf1.fcs:
+        fc1, fc2 = qf1.fcs[0], qf2.fcs[0]
+        h = F.linear(
+            h,
+            torch.cat((fc1.weight, fc2.weight)),
+            torch.cat((fc1.bias, fc2.bias)),
+        )
+        h = qf1.hidden_activation(h.view(h.size(0), 2, -1).transpose(0, 1))
+        for fc1, fc2 in zip(qf1.fcs[1:], qf2.fcs[1:]):
+            h = qf1.hidden_activation(_twin_linear(h, fc1, fc2))
+    else:
+        h = h.unsqueeze(0).expand(2, -1, -1)
+    return qf1.output_activation(_twin_linear(h, qf1.last_fc, qf2.last_fc))
+
+
+def _stats_on_device(name, data):
+    """
+    Same statistics as create_stats_ordered_dict, but computed on the
+    data's device and returned as 0-dim tensors.
+    """
+    data = data.detach().float()
+    std, mean = torch.std_mean(data, unbiased=False)
+    data_min, data_max = torch.aminmax(data)
+    return OrderedDict([
+        (name + ' Mean', mean),
+        (name + ' Std', std),
+        (name + ' Max', data_max),
+        (name + ' Min', data_min),
+    ])
+
+
+@torch.jit.script
+def _bellman_target(rewards, terminals, target_q, reward_scale: float,
+                    discount: float):
+    return reward_scale * rewards + (1. - terminals) * discount * target_q
+
+
+@torch.jit.script
+def _bellman_sq(q_pred, q_target):
+    return (q_pred - q_target) ** 2
+
+
+def _make_bonus_fn(normalize, use_log):
+    """
+    Return the bonus computation for one configuration, as a function of
+    (bonus_module, obs, actions). The normalize / use_log branches are
+    resolved here, once, instead of on every call.
+    """
+    # normalization: (obs - mu) / std as a single fused multiply-add
+    # use log in the bonus
+    # if use_log : log(bonus)
+    # else bonus
+    if normalize and use_log:
+        def bonus_fn(module, obs, actions):
+            obs = torch.addcmul(module.neg_mu_over_std, obs, module.obs_inv_std)
+            return module.log_network(obs, actions)
+    elif normalize:
+        def bonus_fn(module, obs, actions):
+            obs = torch.addcmul(module.neg_mu_over_std, obs, module.obs_inv_std)
+            return module.network(obs, actions)
+    elif use_log:
+        def bonus_fn(module, obs, actions):
+            return module.log_network(obs, actions)
+    else:
+        def bonus_fn(module, obs, actions):
+            return module.network(obs, actions)
+    return bonus_fn
+
+
+def _log_of_activation(activation):
+    """
+    Closed form of log(activation(x)) as a function of x, if there is one.
+    """
+    if activation in (torch.sigmoid, F.sigmoid) or isinstance(
+            activation, nn.Sigmoid):
+        return F.logsigmoid
+    if activation is torch.exp:
+        return nn.Identity()
+    return None
+
+
+class _BonusModule(nn.Module):
+    """
+    Bonus of (obs, actions) under the bonus network, including the optional
+    observation normalization and log, as one module that can be traced.
+    """
+
+    def __init__(self, bonus_network, obs_inv_std, neg_mu_over_std, use_log):
+        super().__init__()
+        self.bonus_network = bonus_network
+        self.normalize = obs_inv_std is not None
+        if self.normalize:
+            self.register_buffer('obs_inv_std', obs_inv_std)
+            self.register_buffer('neg_mu_over_std', neg_mu_over_std)
+        self.use_log = use_log
+        # an Mlp's first layer can be applied to obs and actions separately
+        is_mlp = isinstance(bonus_network, Mlp)
+        if is_mlp and not bonus_network.layer_norm and bonus_network.fcs:
+            self.network = self._split_mlp
+            self.preactivation = self._split_mlp_preactivation
+        else:
+            self.network = self._cat_network
+            self.preactivation = self._cat_mlp_preactivation
+
+        # if use_log and the output activation has a closed-form log (e.g.
+        # log(sigmoid(x)) == logsigmoid(x)), apply that to the Mlp's
+        # preactivation: one kernel less, and no -inf when the bonus
+        # underflows to 0
+        self._log_activation = None
+        if use_log and is_mlp:
+            self._log_activation = _log_of_activation(
+                bonus_network.output_activation
+            )
+        if self._log_activation is not None:
+            self.log_network = self._log_from_preactivation
+        else:
+            self.log_network = self._log_of_network
+        self._bonus_fn = _make_bonus_fn(self.normalize, self.use_log)
+
+    def _cat_network(self, obs, actions):
+        data = torch.cat((obs, actions), dim=1)
+        return self.bonus_network(data)
+
+    def _cat_mlp_preactivation(self, obs, actions):
+        data = torch.cat((obs, actions), dim=1)
+        return self.bonus_network(data, return_preactivations=True)[1]
+
+    def _split_mlp_preactivation(self, obs, actions):
+        """
+        Same as the preactivation of
+        bonus_network(torch.cat((obs, actions), dim=1)), but the first
+        layer's weight is sliced along its input axis so the concatenated
+        input is never materialized.
+        """
+        net = self.bonus_network
+        fc = net.fcs[0]
+        obs_dim = obs.size(1)
+        h = F.linear(obs, fc.weight[:, :obs_dim]) + F.linear(
+            actions, fc.weight[:, obs_dim:], fc.bias
+        )
+        h = net.hidden_activation(h)
+        for fc in net.fcs[1:]:
+            h = net.hidden_activation(fc(h))
+        return net.last_fc(h)
+
+    def _split_mlp(self, obs, actions):
+        return self.bonus_network.output_activation(
+            self._split_mlp_preactivation(obs, actions)
+        )
+
+    def _log_of_network(self, obs, actions):
+        # bonus = torch.log(torch.clamp(bonus, 1e-40, 1))
+        return torch.log(self.network(obs, actions))
+
+    def _log_from_preactivation(self, obs, actions):
+        return self._log_activation(self.preactivation(obs, actions))
+
+    def forward(self, obs, actions):
+        return self._bonus_fn(self, obs, actions)
+
+
 class TD3_Bonus_ADD_Trainer(TorchTrainer):
     """
     Twin Delayed Deep Deterministic policy gradients
@@ -47,6 +250,10 @@ class TD3_Bonus_ADD_Trainer(TorchTrainer):
             tau=0.005,
             qf_criterion=None,
             optimizer_class=optim.Adam,
+            use_compile=False,
+            use_cuda_graph=False,
+            use_amp=False,
+            fuse_twin_q=False,
     ):
         super().__init__()
         if qf_criterion is None:
@@ -61,10 +268,19 @@ class TD3_Bonus_ADD_Trainer(TorchTrainer):
         self.target_policy_noise_clip = target_policy_noise_clip
 
         self.device = device
+        # host-to-device transfer of training batches
+        self._batch_buffers = BatchBuffers(device)
 
         self.bonus_network = bonus_network
         self.beta = beta
 
+        # the bonus network is pretrained and never optimized here. Freezing
+        # it keeps the gradient w.r.t. its inputs (needed by the actor) but
+        # skips computing and storing gradients for its weights.
+        for param in self.bonus_network.parameters():
+            param.requires_grad_(False)
+        self.bonus_network.eval()
+
         # type of adding bonus to critic or policy
         self.use_bonus_critic = use_bonus_critic
         self.use_bonus_policy = use_bonus_policy
@@ -84,9 +300,22 @@ class TD3_Bonus_ADD_Trainer(TorchTrainer):
             self.obs_std = ptu.from_numpy(self.obs_std).to(device)
             # self.actions_mu = ptu.from_numpy(self.actions_mu).to(device)
             # self.actions_std = ptu.from_numpy(self.actions_std).to(device)
+            self._obs_inv_std = (1.0 / self.obs_std).contiguous()
+            self._neg_mu_over_std = (
+                -self.obs_mu * self._obs_inv_std
+            ).contiguous()
+        else:
+            self._obs_inv_std = self._neg_mu_over_std = None
 
         self.rewards_shift_param = rewards_shift_param
 
+        self._get_bonus = _BonusModule(
+            self.bonus_network,
+            self._obs_inv_std,
+            self._neg_mu_over_std,
+            self.use_log,
+        )
+
 
         self.discount = discount
         self.reward_scale = reward_scale
@@ -95,163 +324,513 @@ class TD3_Bonus_ADD_Trainer(TorchTrainer):
         self.tau = tau
         self.qf_criterion = qf_criterion
 
+        # soft-update all three target networks in one call
+        self._soft_update_sources = (
+            list(self.policy.parameters())
+            + list(self.qf1.parameters())
+            + list(self.qf2.parameters())
+        )
+        self._soft_update_targets = (
+            list(self.target_policy.parameters())
+            + list(self.target_qf1.parameters())
+            + list(self.target_qf2.parameters())
+        )
+
+        # optionally evaluate each pair of critics with shared matmuls.
+        # Off by default: the stacked weights are rebuilt on every forward,
+        # which costs about as many kernels as it saves
+        self._fuse_qf = fuse_twin_q and _can_fuse_twin_q(self.qf1, self.qf2)
+        self._fuse_target_qf = fuse_twin_q and _can_fuse_twin_q(
+            self.target_qf1, self.target_qf2
+        )
+        # FlattenMlp critics can be handed an already concatenated input,
+        # so a concatenation is built once and shared where possible
+        self._qf_flat_input = (
+            isinstance(self.qf1, FlattenMlp)
+            and isinstance(self.qf2, FlattenMlp)
+        )
+        self._target_qf_flat_input = (
+            isinstance(self.target_qf1, FlattenMlp)
+            and isinstance(self.target_qf2, FlattenMlp)
+        )
+
+        # replay the whole update step from captured CUDA graphs. Compiling
+        # with mode='reduce-overhead' already uses CUDA graphs, so the two
+        # options are not combined.
+        self.use_cuda_graph = (
+            use_cuda_graph
+            and not (use_compile and hasattr(torch, 'compile'))
+            and torch.device(device).type == 'cuda'
+        )
+        self._train_step_graphs = None
+
+        # optionally run the forward passes and losses under bf16 autocast on
+        # CUDA; parameters and optimizer state stay in fp32, so no GradScaler.
+        # Off by default: the Q-targets are still computed in fp32, but the
+        # bf16 critic predictions are coarse enough to affect the TD errors
+        self.use_amp = use_amp and torch.device(device).type == 'cuda'
+
+        optimizer_kwargs = dict()
+        if self.use_cuda_graph:
+            optimizer_kwargs['capturable'] = True
+        # step all parameters of a network at once: one fused kernel on CUDA,
+        # multi-tensor kernels otherwise, if the optimizer supports it
+        optimizer_params = inspect.signature(optimizer_class).parameters
+        if torch.device(device).type == 'cuda' and 'fused' in optimizer_params:
+            optimizer_kwargs['fused'] = True
+            # fused optimizers check that the parameters are already on CUDA
+            for net in self.networks:
+                net.to(device)
+        elif 'foreach' in optimizer_params:
+            optimizer_kwargs['foreach'] = True
+
         self.qf1_optimizer = optimizer_class(
             self.qf1.parameters(),
             lr=qf_learning_rate,
+            **optimizer_kwargs
         )
         self.qf2_optimizer = optimizer_class(
             self.qf2.parameters(),
             lr=qf_learning_rate,
+            **optimizer_kwargs
         )
         self.policy_optimizer = optimizer_class(
             self.policy.parameters(),
             lr=policy_learning_rate,
+            **optimizer_kwargs
         )
 
         self.eval_statistics = OrderedDict()
+        self._pending_scalars = OrderedDict()
+        self._pending_stats = OrderedDict()
         self._n_train_steps_total = 0
         self._need_to_update_eval_statistics = True
         self.discrete = False
 
-    def _get_bonus(self, obs, actions):
-        if self.normalize:
-            obs = (obs - self.obs_mu) / self.obs_std
-            # actions = (actions - self.actions_mu) / self.actions_std
-        data = torch.cat((obs, actions), dim=1)
-        bonus = self.bonus_network(data)
+        # compile the loss graphs; the bonus is inlined into both of them.
+        # The use_bonus_* / use_log / normalize flags are fixed per trainer,
+        # so each compiled graph is specialized to one branch-free variant.
+        self.use_compile = use_compile and hasattr(torch, 'compile')
+        if self.use_compile:
+            compile_kwargs = dict(
+                mode="reduce-overhead",
+                fullgraph=True,
+                dynamic=False,
+            )
+            self._critic_loss = torch.compile(
+                self._critic_loss, **compile_kwargs
+            )
+            self._policy_loss = torch.compile(
+                self._policy_loss, **compile_kwargs
+            )
+
+        # hot-path forward calls, traced on the first batch unless compiled
+        self._policy_fn = self.policy
+        self._qf1_fn = self.qf1
+        self._qf2_fn = self.qf2
+        self._jit_pending = not self.use_compile
+
+        # outputs of the last policy update, for the eval statistics
+        self._last_policy_actions = None
+        self._last_q_output = None
+        self._last_actor_bonus = None
+
+        # in eager mode on CUDA (the default configuration), unfused critics
+        # are updated concurrently on two streams; compiled and
+        # graph-captured steps schedule themselves
+        self._critic_streams = None
+        if (torch.device(device).type == 'cuda' and not self._fuse_qf
+                and not self.use_compile and not self.use_cuda_graph):
+            self._critic_streams = (
+                torch.cuda.Stream(device=device),
+                torch.cuda.Stream(device=device),
+            )
+
+        # target policy smoothing noise, reused across steps on the eager and
+        # CUDA graph paths (mutating them would break torch.compile's graphs)
+        self._noise_buf = None
+        self._noisy_buf = None
+
+    def _trace_networks(self, obs, actions):
+        """
+        Replace the forward calls on the hot path with traced TorchScript
+        graphs. The traced modules share parameters with the originals,
+        which remain the ones that are optimized and saved.
+        """
+        self._jit_pending = False
+        self._policy_fn = torch.jit.trace(self.policy, (obs,))
+        if self._qf_flat_input:
+            qf_inputs = (torch.cat((obs, actions), dim=1),)
+        else:
+            qf_inputs = (obs, actions)
+        self._qf1_fn = torch.jit.trace(self.qf1, qf_inputs)
+        self._qf2_fn = torch.jit.trace(self.qf2, qf_inputs)
+        self._get_bonus = torch.jit.trace(self._get_bonus, (obs, actions))
+
+    def _autocast(self):
+        return torch.autocast(
+            device_type='cuda',
+            dtype=torch.bfloat16,
+            enabled=self.use_amp,
+            # cached casts must not outlive a CUDA graph capture
+            cache_enabled=not self.use_cuda_graph,
+        )
 
-        # use log in the bonus
-        # if use_log : log(bonus)
-        # else 1 - bonus
-        if self.use_log:
-            # bonus = torch.log(torch.clamp(bonus, 1e-40, 1))
-            bonus = torch.log(bonus)
+    def _allocate_noise_buffers(self, actions):
+        if self._noise_buf is None or self._noise_buf.shape != actions.shape:
+            self._noise_buf = torch.empty_like(actions)
+            self._noisy_buf = torch.empty_like(actions)
+
+    def _q_target(self, rewards, terminals, next_obs):
+        # the target is detached anyway, so don't record a graph for it
+        # (out= below is also only allowed outside of autograd), and keep it
+        # in fp32 so that it isn't quantized under autocast
+        with torch.no_grad(), torch.autocast(
+                device_type='cuda', enabled=False
+        ):
+            next_actions = self.target_policy(next_obs)
+            if self.use_compile:
+                noise = torch.randn_like(next_actions).mul_(
+                    self.target_policy_noise
+                ).clamp_(
+                    -self.target_policy_noise_clip,
+                    self.target_policy_noise_clip
+                )
+                noisy_next_actions = next_actions + noise
+            else:
+                self._noise_buf.normal_(
+                    mean=0.0, std=self.target_policy_noise
+                ).clamp_(
+                    -self.target_policy_noise_clip,
+                    self.target_policy_noise_clip
+                )
+                noisy_next_actions = torch.add(
+                    next_actions, self._noise_buf, out=self._noisy_buf
+                )
+
+            target_q_values = _twin_q(
+                self.target_qf1,
+                self.target_qf2,
+                next_obs,
+                noisy_next_actions,
+                self._fuse_target_qf,
+                self._target_qf_flat_input,
+            ).min(dim=0)[0]
+
+            # use bonus in critic
+            critic_bonus = None
+            if self.use_bonus_critic:
+                critic_bonus = self._get_bonus(next_obs, noisy_next_actions)
+                target_q_values = target_q_values + self.beta * critic_bonus
+
+            q_target = _bellman_target(
+                rewards,
+                terminals,
+                target_q_values,
+                float(self.reward_scale),
+                float(self.discount),
+            )
+            q_target = q_target.detach()
+        return q_target, critic_bonus
+
+    def _critic_loss(self, obs, actions, rewards, terminals, next_obs):
+        q_target, critic_bonus = self._q_target(rewards, terminals, next_obs)
+
+        if self._fuse_qf:
+            qf1, qf2 = self.qf1, self.qf2
         else:
-            bonus = bonus
-        return bonus
+            qf1, qf2 = self._qf1_fn, self._qf2_fn
+        q1_pred, q2_pred = _twin_q(
+            qf1, qf2, obs, actions, self._fuse_qf, self._qf_flat_input
+        ).unbind(0)
+        # the per-sample errors are only materialized for the statistics
+        qf1_loss = F.mse_loss(q1_pred, q_target)
+        qf2_loss = F.mse_loss(q2_pred, q_target)
+
+        return qf1_loss, qf2_loss, q1_pred, q2_pred, q_target, critic_bonus
+
+    def _policy_loss(self, obs):
+        policy_actions = self._policy_fn(obs)
+        if self._qf_flat_input:
+            q_output = self._qf1_fn(torch.cat((obs, policy_actions), dim=1))
+        else:
+            q_output = self._qf1_fn(obs, policy_actions)
 
-    def train_from_torch(self, batch):
-        rewards = batch['rewards']
-        terminals = batch['terminals']
-        obs = batch['observations']
-        actions = batch['actions']
-        next_obs = batch['next_observations']
+        # use bonus in policy
+        actor_bonus = None
+        if self.use_bonus_policy:
+            actor_bonus = self._get_bonus(obs, policy_actions)
+            q_output = q_output + self.beta * actor_bonus
 
+        policy_loss = - q_output.mean()
+        return policy_loss, policy_actions, q_output, actor_bonus
+
+    def _concurrent_critic_update(
+            self, obs, actions, rewards, terminals, next_obs
+    ):
         """
-        Critic operations.
+        Update the two (unfused) critics concurrently, each on its own CUDA
+        stream. Backward ops run on the stream of their forward op, so the
+        forward, backward and optimizer step of each critic all go there.
         """
-
-        next_actions = self.target_policy(next_obs)
-        noise = ptu.randn(next_actions.shape) * self.target_policy_noise
-        noise = torch.clamp(
-            noise,
-            -self.target_policy_noise_clip,
-            self.target_policy_noise_clip
+        with self._autocast():
+            q_target, critic_bonus = self._q_target(
+                rewards, terminals, next_obs
+            )
+        if self._qf_flat_input:
+            qf_inputs = (torch.cat((obs, actions), dim=1),)
+        else:
+            qf_inputs = (obs, actions)
+
+        current_stream = torch.cuda.current_stream(self.device)
+        q_preds, losses = [], []
+        for qf, optimizer, stream in zip(
+                (self._qf1_fn, self._qf2_fn),
+                (self.qf1_optimizer, self.qf2_optimizer),
+                self._critic_streams,
+        ):
+            stream.wait_stream(current_stream)
+            with torch.cuda.stream(stream):
+                with self._autocast():
+                    q_pred = qf(*qf_inputs)
+                    loss = F.mse_loss(q_pred, q_target)
+                optimizer.zero_grad(set_to_none=True)
+                loss.backward()
+                optimizer.step()
+            q_preds.append(q_pred)
+            losses.append(loss)
+        for stream in self._critic_streams:
+            current_stream.wait_stream(stream)
+
+        return (
+            losses[0], losses[1], q_preds[0], q_preds[1], q_target,
+            critic_bonus,
         )
-        noisy_next_actions = next_actions + noise
-
-        target_q1_values = self.target_qf1(next_obs, noisy_next_actions)
-        target_q2_values = self.target_qf2(next_obs, noisy_next_actions)
-        target_q_values = torch.min(target_q1_values, target_q2_values)
 
-        # use bonus in critic
-        if self.use_bonus_critic:
-            with torch.no_grad():
-                critic_bonus = self._get_bonus(next_obs, noisy_next_actions)
-            target_q_values = target_q_values + self.beta * critic_bonus
-
-        q_target = self.reward_scale * rewards + (1. - terminals) * self.discount * target_q_values
-        q_target = q_target.detach()
+    def _train_step(
+            self, obs, actions, rewards, terminals, next_obs, update_policy
+    ):
+        """
+        Critic operations.
+        """
+        if self._critic_streams is not None:
+            critic_outputs = self._concurrent_critic_update(
+                obs, actions, rewards, terminals, next_obs
+            )
+        else:
+            with self._autocast():
+                critic_outputs = self._critic_loss(
+                    obs, actions, rewards, terminals, next_obs
+                )
+            qf1_loss, qf2_loss = critic_outputs[:2]
+
+            """
+            Update Networks
+            """
+            # the two critics may share one autograd graph, so backprop the
+            # sum; each critic's parameters only get gradients from its loss
+            self.qf1_optimizer.zero_grad(set_to_none=True)
+            self.qf2_optimizer.zero_grad(set_to_none=True)
+            (qf1_loss + qf2_loss).backward()
+            self.qf1_optimizer.step()
+            self.qf2_optimizer.step()
+
+        policy_outputs = (None, None, None, None)
+        if update_policy:
+            with self._autocast():
+                policy_outputs = self._policy_loss(obs)
+            policy_loss = policy_outputs[0]
+
+            self.policy_optimizer.zero_grad(set_to_none=True)
+            policy_loss.backward()
+            self.policy_optimizer.step()
 
-        q1_pred = self.qf1(obs, actions)
-        bellman_errors_1 = (q1_pred - q_target) ** 2
-        qf1_loss = bellman_errors_1.mean()
+            ptu.soft_update_params_from_to(
+                self._soft_update_sources,
+                self._soft_update_targets,
+                self.tau,
+            )
 
-        q2_pred = self.qf2(obs, actions)
-        bellman_errors_2 = (q2_pred - q_target) ** 2
-        qf2_loss = bellman_errors_2.mean()
+        return critic_outputs + policy_outputs
 
+    def _capture_train_step(self, obs, actions, rewards, terminals, next_obs):
         """
-        Update Networks
-        """
-        self.qf1_optimizer.zero_grad()
-        qf1_loss.backward()
-        self.qf1_optimizer.step()
+        Capture one CUDA graph for critic-only steps and one for steps that
+        also update the policy and the targets.
 
-        self.qf2_optimizer.zero_grad()
-        qf2_loss.backward()
-        self.qf2_optimizer.step()
+        The graphs read from persistent input buffers. Before capturing, the
+        step runs eagerly a few times on the first batch to initialize the
+        optimizer state. Those warmup updates are undone in place afterwards,
+        so the captured graphs start from the networks as they were.
+        """
+        self._obs_buf = obs.clone()
+        self._act_buf = actions.clone()
+        self._rew_buf = rewards.clone()
+        self._term_buf = terminals.clone()
+        self._next_obs_buf = next_obs.clone()
+        inputs = (
+            self._obs_buf,
+            self._act_buf,
+            self._rew_buf,
+            self._term_buf,
+            self._next_obs_buf,
+        )
 
-        policy_actions = policy_loss = None
-        if self._n_train_steps_total % self.policy_and_target_update_period == 0:
-            policy_actions = self.policy(obs)
-            q_output = self.qf1(obs, policy_actions)
+        optimizers = (
+            self.qf1_optimizer,
+            self.qf2_optimizer,
+            self.policy_optimizer,
+        )
+        network_states = [
+            {k: v.clone() for k, v in net.state_dict().items()}
+            for net in self.networks
+        ]
 
-            # use bonus in policy
-            if self.use_bonus_policy:
-                actor_bonus = self._get_bonus(obs, policy_actions)
-                q_output = q_output + self.beta * actor_bonus
+        # ptu.set_gpu_mode does not change the current CUDA device, so the
+        # streams and graphs have to be created on the trainer's device
+        with torch.cuda.device(self.device):
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self._train_step(*inputs, update_policy=True)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            # undo the warmup updates without reallocating anything: load
+            # the saved parameters and reset the optimizer state to zero
+            for net, state in zip(self.networks, network_states):
+                net.load_state_dict(state)
+            for optimizer in optimizers:
+                for param_state in optimizer.state.values():
+                    for key, value in param_state.items():
+                        if torch.is_tensor(value):
+                            value.zero_()
+                        else:
+                            param_state[key] = 0
+
+            self._train_step_graphs = dict()
+            for update_policy in (False, True):
+                for optimizer in optimizers:
+                    optimizer.zero_grad(set_to_none=True)
+                graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(graph):
+                    outputs = self._train_step(
+                        *inputs, update_policy=update_policy
+                    )
+                self._train_step_graphs[update_policy] = (graph, outputs)
+
+    def _replay_train_step(
+            self, obs, actions, rewards, terminals, next_obs, update_policy
+    ):
+        if self._train_step_graphs is None:
+            self._capture_train_step(obs, actions, rewards, terminals, next_obs)
+        self._obs_buf.copy_(obs, non_blocking=True)
+        self._act_buf.copy_(actions, non_blocking=True)
+        self._rew_buf.copy_(rewards, non_blocking=True)
+        self._term_buf.copy_(terminals, non_blocking=True)
+        self._next_obs_buf.copy_(next_obs, non_blocking=True)
+        graph, outputs = self._train_step_graphs[update_policy]
+        graph.replay()
+        return outputs
+
+    def train(self, np_batch):
+        self._num_train_steps += 1
+        batch = self._batch_buffers.to_device(np_batch)
+        self.train_from_torch(batch)
 
-            policy_loss = - q_output.mean()
+    def train_from_torch(self, batch):
+        rewards = batch['rewards']
+        terminals = batch['terminals']
+        obs = batch['observations']
+        actions = batch['actions']
+        next_obs = batch['next_observations']
 
-            self.policy_optimizer.zero_grad()
-            policy_loss.backward()
-            self.policy_optimizer.step()
+        if self._jit_pending:
+            self._trace_networks(obs, actions)
+        if not self.use_compile:
+            self._allocate_noise_buffers(actions)
 
-            ptu.soft_update_from_to(self.policy, self.target_policy, self.tau)
-            ptu.soft_update_from_to(self.qf1, self.target_qf1, self.tau)
-            ptu.soft_update_from_to(self.qf2, self.target_qf2, self.tau)
+        update_policy = (
+            self._n_train_steps_total % self.policy_and_target_update_period == 0
+        )
+        if self.use_cuda_graph:
+            outputs = self._replay_train_step(
+                obs, actions, rewards, terminals, next_obs, update_policy
+            )
+        else:
+            if self.use_compile and hasattr(torch, 'compiler'):
+                # outputs of the previous step are no longer needed
+                torch.compiler.cudagraph_mark_step_begin()
+            outputs = self._train_step(
+                obs, actions, rewards, terminals, next_obs, update_policy
+            )
+        (
+            qf1_loss, qf2_loss, q1_pred, q2_pred, q_target, critic_bonus,
+            policy_loss, policy_actions, q_output, actor_bonus,
+        ) = outputs
+
+        if policy_loss is not None:
+            # keep the latest policy outputs for the eval statistics
+            self._last_policy_actions = policy_actions.detach()
+            self._last_q_output = q_output.detach()
+            self._last_actor_bonus = (
+                None if actor_bonus is None else actor_bonus.detach()
+            )
+            if self.use_compile:
+                # compiled outputs are overwritten by the next call
+                self._last_policy_actions = self._last_policy_actions.clone()
+                self._last_q_output = self._last_q_output.clone()
+                if actor_bonus is not None:
+                    self._last_actor_bonus = self._last_actor_bonus.clone()
 
         if self._need_to_update_eval_statistics:
             self._need_to_update_eval_statistics = False
             if policy_loss is None:
-                policy_actions = self.policy(obs)
-                q_output = self.qf1(obs, policy_actions)
-                policy_loss = - q_output.mean()
-
-            self.eval_statistics['QF1 Loss'] = np.mean(ptu.get_numpy(qf1_loss))
-            self.eval_statistics['QF2 Loss'] = np.mean(ptu.get_numpy(qf2_loss))
-            self.eval_statistics['Policy Loss'] = np.mean(ptu.get_numpy(
-                policy_loss
-            ))
-            self.eval_statistics.update(create_stats_ordered_dict(
-                'Q1 Predictions',
-                ptu.get_numpy(q1_pred),
-            ))
-            self.eval_statistics.update(create_stats_ordered_dict(
-                'Q2 Predictions',
-                ptu.get_numpy(q2_pred),
-            ))
-            self.eval_statistics.update(create_stats_ordered_dict(
-                'Q Targets',
-                ptu.get_numpy(q_target),
-            ))
-            self.eval_statistics.update(create_stats_ordered_dict(
-                'Bellman Errors 1',
-                ptu.get_numpy(bellman_errors_1),
-            ))
-            self.eval_statistics.update(create_stats_ordered_dict(
-                'Bellman Errors 2',
-                ptu.get_numpy(bellman_errors_2),
-            ))
-            self.eval_statistics.update(create_stats_ordered_dict(
-                'Policy Action',
-                ptu.get_numpy(policy_actions),
-            ))
+                # reuse the outputs of the last policy update; step 0 always
+                # updates the policy, so they are set by now
+                policy_actions = self._last_policy_actions
+                actor_bonus = self._last_actor_bonus
+                policy_loss = - self._last_q_output.mean()
+
+            q1_pred = q1_pred.detach()
+            q2_pred = q2_pred.detach()
+            bellman_errors_1 = _bellman_sq(q1_pred, q_target)
+            bellman_errors_2 = _bellman_sq(q2_pred, q_target)
+            stat_tensors = OrderedDict([
+                ('Q1 Predictions', q1_pred),
+                ('Q2 Predictions', q2_pred),
+                ('Q Targets', q_target),
+                ('Bellman Errors 1', bellman_errors_1),
+                ('Bellman Errors 2', bellman_errors_2),
+                ('Policy Action', policy_actions),
+            ])
             # bonus
             if self.use_bonus_policy:
-                self.eval_statistics.update(create_stats_ordered_dict(
-                    'Actor Bonus',
-                    ptu.get_numpy(actor_bonus),
-                ))
+                stat_tensors['Actor Bonus'] = actor_bonus
             if self.use_bonus_critic:
-                self.eval_statistics.update(create_stats_ordered_dict(
-                    'Critic Bonus',
-                    ptu.get_numpy(critic_bonus),
-                ))
+                stat_tensors['Critic Bonus'] = critic_bonus
+
+            # keep everything on the device; the results are only copied
+            # once get_diagnostics is called. Compiled and graph-replayed
+            # outputs are overwritten by later steps, hence the clones.
+            self._pending_scalars['QF1 Loss'] = qf1_loss.detach().clone()
+            self._pending_scalars['QF2 Loss'] = qf2_loss.detach().clone()
+            self._pending_scalars['Policy Loss'] = policy_loss.detach().clone()
+            for name, data in stat_tensors.items():
+                self._pending_stats.update(_stats_on_device(name, data))
         self._n_train_steps_total += 1
 
     def get_diagnostics(self):
+        pending = OrderedDict(self._pending_scalars)
+        pending.update(self._pending_stats)
+        if pending:
+            # a single device-to-host copy for all pending values
+            values = ptu.get_numpy(
+                torch.stack([value.float() for value in pending.values()])
+            )
+            self.eval_statistics.update(zip(pending, values))
+            self._pending_scalars.clear()
+            self._pending_stats.clear()
         return self.eval_statistics
 
     def end_epoch(self, epoch):